@@ -1,113 +1,379 @@
 
-from collections import defaultdict
+from bisect import bisect
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
-from functools import cache
-from itertools import zip_longest
-from math import log
-from random import randint
+from functools import cache, wraps
+from hashlib import blake2b
+from itertools import accumulate, chain, repeat
+from math import comb, log
+from operator import itemgetter
+from os import environ
+from pathlib import Path
+import pickle
+from random import Random
+from tempfile import NamedTemporaryFile
+from types import MappingProxyType
+from weakref import WeakValueDictionary
 
 trials = 1000
+# seed this for reproducible sampling
+rng = Random()
+cache_dir = Path(environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) \
+        / "eastfront"
+# bump whenever the format of cached results changes
+cache_version = 2
+_worker_pool = None
 
-def d6(): return randint(1,6)
+def worker_pool():
+    # created on first use and reused, process start-up is not cheap
+    global _worker_pool
+    if _worker_pool is None: _worker_pool = ProcessPoolExecutor()
+    return _worker_pool
 
-@dataclass(frozen=True)
+def disk_cache(function):
+    @wraps(function)
+    def cached_function(*args):
+        # repr rather than pickle: pickle output depends on which equal
+        # objects happen to be shared, repr only on the values
+        key = blake2b(repr(
+            (cache_version, function.__qualname__, args)).encode()).hexdigest()
+        path = cache_dir / f"{key}.pickle"
+        try:
+            with path.open("rb") as cached: return pickle.load(cached)
+        except (OSError, EOFError, pickle.UnpicklingError): pass
+        result = function(*args)
+        try:
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            with NamedTemporaryFile(dir=cache_dir, suffix=".partial",
+                    delete=False) as cached:
+                pickle.dump(result, cached)
+            Path(cached.name).replace(path)
+        except OSError: pass
+        return result
+    return cached_function
+
+# probabilities are kept as integer counts of equally likely d6 rolls,
+# out of 6**dice, and only divided out once at the end
+@cache
+def hit_counts(dice: int, hit_faces: int):
+    # hits from rolling dice d6s that each hit on hit_faces faces of six
+    return tuple(comb(dice, hits) * hit_faces**hits
+            * (6 - hit_faces)**(dice - hits)
+            for hits in range(dice + 1))
+
+def convolve(counts1, counts2):
+    result = [0] * (len(counts1) + len(counts2) - 1)
+    for hits1, count1 in enumerate(counts1):
+        for hits2, count2 in enumerate(counts2):
+            result[hits1 + hits2] += count1 * count2
+    return tuple(result)
+
+@cache
+def damage_counts(triple_dice: int, double_dice: int, single_dice: int):
+    # triple fire hits on 4-6, double fire on 5-6, single fire on 6
+    return convolve(convolve(hit_counts(triple_dice, 3),
+            hit_counts(double_dice, 2)), hit_counts(single_dice, 1))
+
+@cache
+def cumulative_damage_counts(
+        triple_dice: int, double_dice: int, single_dice: int
+):
+    return tuple(accumulate(
+            damage_counts(triple_dice, double_dice, single_dice)))
+
+# make() hands out one shared instance per distinct value, so that the
+# many equal troops and standings met during a computation compare by
+# identity in dict lookups
+@dataclass(frozen=True, slots=True, weakref_slot=True)
 class BattleTroops:
     triple_fire_cv: tuple[int] = ()
     double_fire_cv: tuple[int] = ()
     single_fire_cv: tuple[int] = ()
 
-@dataclass(frozen=True)
+    _intern_pool = WeakValueDictionary()
+
+    @classmethod
+    def make(cls, triple_fire_cv: tuple[int] = (),
+            double_fire_cv: tuple[int] = (), single_fire_cv: tuple[int] = ()):
+        key = (triple_fire_cv, double_fire_cv, single_fire_cv)
+        troops = cls._intern_pool.get(key)
+        if troops is None: troops = cls._intern_pool[key] = cls(*key)
+        return troops
+
+@dataclass(frozen=True, slots=True, weakref_slot=True)
 class BattleStanding:
     attacker: BattleTroops = BattleTroops()
     defender: BattleTroops = BattleTroops()
 
-def apply_damage(victim: BattleTroops, aggressor: BattleTroops):
-    damage = sum(1 for _ in range(sum(aggressor.triple_fire_cv)) if d6() >= 4) \
-           + sum(1 for _ in range(sum(aggressor.double_fire_cv)) if d6() >= 5) \
-           + sum(1 for _ in range(sum(aggressor.single_fire_cv)) if d6() >= 6)
+    _intern_pool = WeakValueDictionary()
+
+    @classmethod
+    def make(cls, attacker: BattleTroops = BattleTroops(),
+            defender: BattleTroops = BattleTroops()):
+        key = (attacker, defender)
+        standing = cls._intern_pool.get(key)
+        if standing is None: standing = cls._intern_pool[key] = cls(*key)
+        return standing
+
+def total_cv(troops: BattleTroops):
+    return sum(troops.triple_fire_cv) + sum(troops.double_fire_cv) \
+            + sum(troops.single_fire_cv)
+
+def fire_dice(aggressor: BattleTroops):
+    return sum(aggressor.triple_fire_cv), sum(aggressor.double_fire_cv), \
+            sum(aggressor.single_fire_cv)
+
+def roll_damage(aggressor: BattleTroops):
+    # one draw over all 6**dice rolls against the cumulative counts
+    return bisect(cumulative_damage_counts(*fire_dice(aggressor)),
+            rng.randrange(6**total_cv(aggressor)))
+
+def _assign(triple: list[int], double: list[int], single: list[int],
+        damage: int):
+    # on equal CV the weaker-firing tier takes the hit, hence the order
+    tiers = (triple, double, single)
+    while damage > 0:
+        strongest, tier = max((max(cvs, default=0), tier)
+                for tier, cvs in enumerate(tiers))
+        if strongest == 0: break
+        tiers[tier][tiers[tier].index(strongest)] -= 1
+        damage -= 1
+
+@cache
+def assign_damage(victim: BattleTroops, damage: int):
     if damage == 0: return victim
+    if damage >= total_cv(victim):
+        # overkill: every unit is eliminated, no need to walk the loop
+        return BattleTroops.make((0,) * len(victim.triple_fire_cv),
+                (0,) * len(victim.double_fire_cv),
+                (0,) * len(victim.single_fire_cv))
+    if len(victim.triple_fire_cv) + len(victim.double_fire_cv) \
+            + len(victim.single_fire_cv) == 1:
+        # a lone unit simply takes all of the damage
+        return BattleTroops.make(
+                *(tuple(cv - damage for cv in cvs) for cvs in (
+                victim.triple_fire_cv, victim.double_fire_cv,
+                victim.single_fire_cv)))
     result_triple = list(victim.triple_fire_cv)
     result_double = list(victim.double_fire_cv)
     result_single = list(victim.single_fire_cv)
-    while damage > 0:
-        max_triple = max(result_triple, default=0)
-        max_double = max(result_double, default=0)
-        max_single = max(result_single, default=0)
-        if max_triple > max_double and max_triple > max_single:
-            result_triple[result_triple.index(max_triple)] -= 1
-        elif max_double > max_single:
-            result_double[result_double.index(max_double)] -= 1
-        elif max_single > 0:
-            result_single[result_single.index(max_single)] -= 1
-        else: break
-        damage -= 1
-    return BattleTroops(tuple(result_triple),
+    _assign(result_triple, result_double, result_single, damage)
+    return BattleTroops.make(tuple(result_triple),
             tuple(result_double),
             tuple(result_single))
 
+def apply_damage(victim: BattleTroops, aggressor: BattleTroops):
+    return assign_damage(victim, roll_damage(aggressor))
+
+def damage_outcome_counts(victim: BattleTroops, aggressor: BattleTroops):
+    # out of 6**total_cv(aggressor)
+    result = Counter()
+    for damage, count in enumerate(damage_counts(*fire_dice(aggressor))):
+        result[assign_damage(victim, damage)] += count
+    return result
+
+def sample_damage_outcomes(
+        victim: BattleTroops, aggressor: BattleTroops, count: int,
+        generator: Random
+):
+    # exact integer draws over all 6**dice rolls, as in roll_damage
+    cumulative_counts = cumulative_damage_counts(*fire_dice(aggressor))
+    rolls = cumulative_counts[-1]
+    result = Counter()
+    for damage, damage_count in Counter(
+            bisect(cumulative_counts, generator.randrange(rolls))
+            for _ in range(count)).items():
+        result[assign_damage(victim, damage)] += damage_count
+    return result
+
 def battle_round_outcome(init: BattleStanding, air_strike: BattleTroops):
     firing_defenders = apply_damage(init.defender, air_strike)
     remaining_attackers = apply_damage(init.attacker, firing_defenders)
     remaining_defenders = apply_damage(firing_defenders, remaining_attackers)
-    return BattleStanding(remaining_attackers, remaining_defenders)
+    return BattleStanding.make(remaining_attackers, remaining_defenders)
 
+@cache
 def battle_round_outcome_distribution(
         init: BattleStanding, air_strike: BattleTroops
 ):
-    result = defaultdict(int)
-    for _ in range(trials):
-        result[battle_round_outcome(init, air_strike)] += 1./trials
+    # later phases roll fewer dice when earlier ones caused losses; scale
+    # their counts up to the dice the initial troops would roll
+    defender_dice, attacker_dice = total_cv(init.defender), \
+            total_cv(init.attacker)
+    counts = Counter()
+    for firing_defenders, air_strike_count in \
+            damage_outcome_counts(init.defender, air_strike).items():
+        defender_fire_scale = \
+                6**(defender_dice - total_cv(firing_defenders))
+        for remaining_attackers, defender_fire_count in \
+                damage_outcome_counts(
+                init.attacker, firing_defenders).items():
+            attacker_fire_scale = \
+                    6**(attacker_dice - total_cv(remaining_attackers))
+            for remaining_defenders, attacker_fire_count in \
+                    damage_outcome_counts(
+                    firing_defenders, remaining_attackers).items():
+                counts[BattleStanding.make(remaining_attackers,
+                        remaining_defenders)] += \
+                        air_strike_count * defender_fire_count \
+                        * defender_fire_scale * attacker_fire_count \
+                        * attacker_fire_scale
+    rolls = 6**(total_cv(air_strike) + defender_dice + attacker_dice)
+    recurse_count = counts.pop(init, 0)
+    result = {standing: count / rolls for standing, count in counts.items()}
+    # cached, so hand out a read-only view
+    return recurse_count / rolls, MappingProxyType(result)
+
+def sample_round_outcomes(
+        init: BattleStanding, air_strike: BattleTroops, count: int,
+        seed: int | None = None
+):
+    # trials are batched by the troops they have reached: every distinct
+    # situation rolls the damage for all of its trials in one go
+    # a seed gets its own stream rather than resetting the shared rng
+    generator = rng if seed is None else Random(seed)
+    result = Counter()
+    for firing_defenders, air_strike_count in \
+            sample_damage_outcomes(init.defender, air_strike, count,
+            generator).items():
+        for remaining_attackers, defender_fire_count in \
+                sample_damage_outcomes(init.attacker, firing_defenders,
+                air_strike_count, generator).items():
+            for remaining_defenders, attacker_fire_count in \
+                    sample_damage_outcomes(firing_defenders,
+                    remaining_attackers, defender_fire_count,
+                    generator).items():
+                result[BattleStanding.make(remaining_attackers,
+                        remaining_defenders)] += attacker_fire_count
     return result
 
+def sampled_round_outcome_distribution(
+        init: BattleStanding, air_strike: BattleTroops,
+        num_workers: int = 1
+):
+    if num_workers <= 1:
+        counts = sample_round_outcomes(init, air_strike, trials)
+    else:
+        chunks = [trials // num_workers + (worker < trials % num_workers)
+                for worker in range(num_workers)]
+        counts = sum(worker_pool().map(sample_round_outcomes,
+                [init] * num_workers, [air_strike] * num_workers, chunks,
+                # an independent stream per worker, drawn from ours
+                [rng.getrandbits(64) for _ in range(num_workers)]),
+                Counter())
+    # split like battle_round_outcome_distribution, for direct comparison
+    recurse_count = counts.pop(init, 0)
+    return recurse_count / trials, \
+            {standing: count / trials for standing, count in counts.items()}
+
+def repeated_battle_distribution(
+        nrounds: int, init: BattleStanding, air_strike: BattleTroops
+):
+    # push the whole distribution forward a round at a time; standings
+    # merge as they are reached, so the work is per state, not per path
+    distribution = {init: 1.}
+    for _ in range(nrounds):
+        next_distribution = defaultdict(float)
+        for standing, probability in distribution.items():
+            if is_over(standing):
+                next_distribution[standing] += probability
+                continue
+            recurse_probability, one_round = \
+                    battle_round_outcome_distribution(standing, air_strike)
+            next_distribution[standing] += probability * recurse_probability
+            for next_standing, transition_probability in one_round.items():
+                next_distribution[next_standing] += \
+                        probability * transition_probability
+        distribution = next_distribution
+    return distribution
+
 def order_by_likelihood(outcome_distribution):
+    # reverse sorting is stable too, so equally likely standings keep
+    # their order as before
     return sorted(((prob, standing)
             for standing, prob in outcome_distribution.items()),
-            key = lambda x: -x[0])
+            key = itemgetter(0), reverse = True)
 
 def is_defeated(troops: BattleTroops):
-    return sum(troops.triple_fire_cv \
-            + troops.double_fire_cv \
-            + troops.single_fire_cv) == 0
+    return total_cv(troops) == 0
 
-def outcome_sum(outcome1, outcome2, weight1, weight2):
-    return [(weight1*victory1+weight2*victory2, weight1*defeat1+weight2*defeat2)
-            for (victory1, defeat1), (victory2, defeat2)
-            in zip_longest(outcome1, outcome2, fillvalue=(0.,0.))]
+def is_over(standing: BattleStanding):
+    return is_defeated(standing.attacker) or is_defeated(standing.defender)
+
+def accumulate_outcome(total, outcome, weight, delay=0):
+    # total += weight * outcome shifted by delay turns, in place
+    total.extend([(0.,0.)] * (delay + len(outcome) - len(total)))
+    for turn, (victory, defeat) in enumerate(outcome, delay):
+        total_victory, total_defeat = total[turn]
+        total[turn] = (total_victory + weight*victory,
+                total_defeat + weight*defeat)
 
 def recursive_regression(extended_outcome, recurse_probability):
-    # approximate number of regressions to cover 99% of cases
-    regression_length = round(-5. / log(recurse_probability))
-    result = extended_outcome
-    for _ in range(regression_length):
-        result = outcome_sum(extended_outcome,
-                [(0.,0.)] + result, 1., recurse_probability)
+    # fixed point of x = outcome + p * (x delayed by a turn), in one pass:
+    # turn i gets sum of p**k * outcome[i-k]; the tail past the outcome
+    # runs long enough to cover 99% of cases
+    regression_length = round(-5. / log(recurse_probability)) \
+            if recurse_probability > 0 else 0
+    result, victory, defeat = [], 0., 0.
+    for new_victory, new_defeat in chain(extended_outcome,
+            repeat((0.,0.), regression_length)):
+        victory = recurse_probability*victory + new_victory
+        defeat = recurse_probability*defeat + new_defeat
+        result.append((victory, defeat))
     return result
 
-@cache
-def extended_outcome_distribution(
-        init: BattleStanding, air_strike: BattleTroops
-):
-    if is_defeated(init.attacker): return [(0.,1.)]
-    if is_defeated(init.defender): return [(1.,0.)]
-    one_round = battle_round_outcome_distribution(init, air_strike)
-    try:
-        recurse_probability = one_round.pop(init)
-    except KeyError:
-        recurse_probability = 0.000000001
-    regression_history, instant_win_prob, instant_defeat_prob = [], 0., 0.
+# outcomes of every standing solved so far, by (standing, air_strike),
+# shared by all calls so that common sub-battles are solved only once
+known_outcomes = {}
+
+def unfinished_standings(init: BattleStanding, air_strike: BattleTroops):
+    # every standing a battle from init can pass through before it is
+    # over and that is not solved yet, each after all the standings it
+    # can lead to: a round never adds CV, so ordering by total CV does it
+    seen, frontier = {init}, [init]
+    while frontier:
+        _, one_round = \
+                battle_round_outcome_distribution(frontier.pop(), air_strike)
+        for next_standing in one_round:
+            if next_standing not in seen and not is_over(next_standing) \
+                    and (next_standing, air_strike) not in known_outcomes:
+                seen.add(next_standing)
+                frontier.append(next_standing)
+    return sorted(seen, key = lambda standing:
+            total_cv(standing.attacker) + total_cv(standing.defender))
+
+def one_step_extended_outcome(init: BattleStanding, air_strike: BattleTroops):
+    recurse_probability, one_round = \
+            battle_round_outcome_distribution(init, air_strike)
+    result_without_recursion = [(0.,0.)]
+    instant_win_prob, instant_defeat_prob = 0., 0.
     for next_standing, probability in one_round.items():
         if is_defeated(next_standing.defender):
             instant_win_prob += probability
         elif is_defeated(next_standing.attacker):
             instant_defeat_prob += probability
         else:
-            regression_history = outcome_sum(
-                extended_outcome_distribution(next_standing, air_strike),
-                regression_history, probability, 1.)
-    result_without_recursion = \
-            [(instant_win_prob, instant_defeat_prob)] + regression_history
+            accumulate_outcome(result_without_recursion,
+                known_outcomes[next_standing, air_strike], probability,
+                delay=1)
+    result_without_recursion[0] = (instant_win_prob, instant_defeat_prob)
     return recursive_regression(result_without_recursion, recurse_probability)
 
+@cache
+@disk_cache
+def extended_outcome_distribution(
+        init: BattleStanding, air_strike: BattleTroops
+):
+    if is_defeated(init.attacker): return [(0.,1.)]
+    if is_defeated(init.defender): return [(1.,0.)]
+    # bottom-up over the reachable standings instead of recursing
+    if (init, air_strike) not in known_outcomes:
+        for standing in unfinished_standings(init, air_strike):
+            known_outcomes[standing, air_strike] = \
+                    one_step_extended_outcome(standing, air_strike)
+    return known_outcomes[init, air_strike]
+
 def interpret_extended_outcome(extended_outcome):
     win_prob = sum(win for win, _ in extended_outcome)
     loss_prob = sum(loss for _, loss in extended_outcome)